@@ -7,10 +7,10 @@ from make import RUN; RUN(__name__,__file__,2)
 #--------------------------------------------------------------------------------------------------
 
 import subprocess
-from numpy import square
 from ..fractals import MultiZoomFractal, FractalBrowser
+from ..fractals.util import geometric_schedule
 
-mandelbrot = MultiZoomFractal((lambda z,c: square(z)+c),ibounds=((-.779,-.774),(.133,.138)),eoracle=2.)
+mandelbrot = MultiZoomFractal('z*z+c',ibounds=((-.779,-.774),(.133,.138)),eoracle=2.,schedule=geometric_schedule(256,1.05)) # beyond 256, redraw only every 5% of precision
 
 def demo():
   from matplotlib.pyplot import show,close
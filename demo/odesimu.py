@@ -5,26 +5,35 @@
 from make import RUN; RUN(__name__,__file__,2)
 #--------------------------------------------------------------------------------------------------
 
-import subprocess
+import subprocess, math
 from collections import namedtuple
 from enum import Enum
-from numpy import array,square,sqrt,cos,sin,arccos,arcsin,degrees,radians,pi,isclose
+from numpy import array,empty,multiply,ndim,square,sqrt,cos,sin,arccos,arcsin,degrees,radians,pi,isclose
 from myutil.simpy import SimpySimulation
 from ..odesimu import System
 Trajectory = namedtuple('Trajectory','periodicity alpha T name display')
 Periodicity = Enum('Periodicity','Aperiodic Periodic IncrementalPeriodic')
+try: # so this works even if numba is not available: the period integrand is then called through python
+  from numba import cfunc, types
+  from scipy import LowLevelCallable
+  @cfunc(types.float64(types.intc,types.CPointer(types.float64)))
+  def period_integrand(n,x): return 1/math.sqrt(math.cos(x[0])-x[1])
+  period_integrand = LowLevelCallable(period_integrand.ctypes)
+except: period_integrand = (lambda θ,c: 1/sqrt(cos(θ)-c))
 
 class Pendulum (System):
 
+  __slots__ = 'L','G','a'
+
   def __init__(self,L,G): self.L,self.G,self.a = L,G,G/L
 
-  def fun(self,t,state): # required
+  def fun(self,t,state,sin=math.sin): # required (scalar trigonometry is much cheaper than numpy's on a single value)
     theta,dtheta = state
     return array((dtheta,-self.a*sin(theta)))
 
-  def jac(self,t,state): # optional
+  def jac(self,t,state,cos=math.cos): # optional
     theta,dtheta = state
-    return array(((0,1),(-self.a*cos(theta),0)))
+    return array(((0.,1.),(-self.a*cos(theta),0.)))
 
   @staticmethod
   def makestate(theta,dtheta=0.): # required
@@ -49,7 +58,10 @@ class Pendulum (System):
 
   def cartesian(self,state):
     theta,dtheta = state
-    return self.L*array((sin(theta),-cos(theta)))
+    if ndim(theta)==0: return self.L*math.sin(theta),-self.L*math.cos(theta) # single state: no array allocation
+    r = empty((2,*theta.shape)) # sequence of states (e.g. cached states, time is the last axis): one vectorized pass per coordinate
+    multiply(self.L,sin(theta,out=r[0]),out=r[0]); multiply(-self.L,cos(theta,out=r[1]),out=r[1])
+    return r
 
   def trajectory(self,init_y): # precomputes the trajectory
     from scipy.integrate import quad
@@ -61,15 +73,16 @@ class Pendulum (System):
     else:
       if c<-1: periodicity = Periodicity.IncrementalPeriodic; name = 'incremental period'; α = pi
       else: periodicity = Periodicity.Periodic; name = 'half-period'; α = arccos(c)
-      T = pi/sqrt(2) if isclose(α,0.) else quad((lambda θ,c=c: 1/sqrt(cos(θ)-c)),0,α)[0]
+      T = pi/sqrt(2) if isclose(α,0.) else quad(period_integrand,0,α,args=(c,))[0]
       T *= sqrt(2/self.a)
       name = f'{name}: {T:.2f}'
-    name = f'CircularArc($R={self.L:.2f}$,$\\alpha={degrees(α):.2f}$) {name}'
+    α_ = degrees(α)
+    name = f'CircularArc($R={self.L:.2f}$,$\\alpha={α_:.2f}$) {name}'
     def display(ax):
       from matplotlib.patches import Arc
       ax.set_title(f'Trajectory:{name}',fontsize='x-small')
       ax.scatter(*zip(*map(self.cartesian,((-α,0),(α,0)))),marker='+',c='k')
-      ax.add_patch(Arc((0,0),2*self.L,2*self.L,-90,-degrees(α),degrees(α),color='k',ls='dashed'))
+      ax.add_patch(Arc((0,0),2*self.L,2*self.L,angle=-90,theta1=-α_,theta2=α_,color='k',ls='dashed'))
     return Trajectory(periodicity,α,T,name,display)
 
 def demo():
@@ -1,6 +1,9 @@
-from functools import wraps, partial
-from collections import OrderedDict
+from functools import wraps, partial, lru_cache, update_wrapper
+from weakref import WeakKeyDictionary
+from types import FunctionType
 import inspect, re
+try: import re2 # so this works even if google-re2 is not available
+except: re2 = re
 
 #==================================================================================================
 def Setup(*H,**D):
@@ -23,21 +26,22 @@ Example::
 
 The helper for a list of :func:`Setup` annotated functions can be obtained by invoking :func:`Setup.display` with the elements of the list as arguments. The list can also contain classes, which stand for all their :func:`Setup` annotated members.
   """
-  def parse(h,pat=re.compile(r'(?P<argn>(?:\w|,)+?)\s*:\s+(?P<help>[^[]+)(?:\s+\[(?P<unit>(?:\w+(?:\^-?[0-9]+)?)(?:\.\w+(?:\^-?[0-9]+)?)*)\])?'),upat=re.compile(r'(?P<base>[^\^]+)(?:\^(?P<expn>.+))?')):
+  def parse(h):
     def unit(x):
-      g = upat.fullmatch(x).groupdict()
+      g = UNIT_PAT.fullmatch(x).groupdict()
       return g['base'],(1 if g['expn'] is None else int(g['expn']))
-    g = pat.fullmatch(h.strip()).groupdict()
+    g = HELP_PAT.fullmatch(h.strip()).groupdict()
     return tuple(g['argn'].split(',')),(g['help'],(() if g['unit'] is None else tuple(unit(x) for x in g['unit'].split('.'))))
   def tr(f):
     assert inspect.isfunction(f)
-    if D:
+    P = inspect.signature(f).parameters
+    if all(k in P and P[k].kind in KEYWORD_KINDS and same(P[k].default,v) for k,v in D.items()): F = f # D merely re-states defaults of f
+    elif (F:=with_defaults(f,D)) is None: # D cannot be set as actual defaults of f
       @wraps(f)
-      def F(*a,**ka): return f(*a,**dict(D,**ka))
-    else: F = f
+      def F(*a,**ka): return f(*a,**{**D,**ka})
     F.setup = H_,D_
     return F
-  H_,D_ = OrderedDict(),{}
+  H_,D_ = {},{}
   for h in H:
     if isinstance(h,str): k,v = parse(h); H_[k] = v
     else: H_.update(h.setup[0]); D_.update(h.setup[1])
@@ -48,30 +52,34 @@ The helper for a list of :func:`Setup` annotated functions can be obtained by in
 class display:
 #==================================================================================================
 
-  def __init__(self,*L): self.L = L
+  __slots__ = 'L','head_style','value_style'
+
+  def __init__(self,*L,head_style='background-color: gray; color: white; font-weight: bold;',value_style='max-width:2cm; white-space: nowrap; overflow: hidden'):
+    self.L,self.head_style,self.value_style = L,head_style,value_style
 
   def _repr_html_(self):
-    from lxml.builder import E
-    from lxml.etree import tostring
+    E,tostring = lxml_builder()
+    TABLE,TBODY,TR,TH,TD,SPAN,SUP = E.TABLE,E.TBODY,E.TR,E.TH,E.TD,E.SPAN,E.SUP
+    head_style,value_style = self.head_style,self.value_style
     def row(f):
-      yield E.TR(E.TD(pname(f),colspan='4',style='background-color: gray; color: white; font-weight: bold;'))
+      yield TR(TD(pname(f),colspan='4',style=head_style))
       H,D = f.setup
       for argn,(txt,unit) in H.items():
-        dv = ','.join(repr(D[a]) if a in D else '' for a in argn) if any(a in D for a in argn) else ''
-        yield E.TR(E.TH(','.join(argn)),E.TD(dv,style='max-width:2cm; white-space: nowrap; overflow: hidden',title=dv),E.TD(txt),E.TD(*uncomp(unit)))
+        dv = defaults(argn,D,repr) or ''
+        yield TR(TH(','.join(argn)),TD(dv,style=value_style,title=dv),TD(txt),TD(*uncomp(unit)))
     def uncomp(u):
       for base,expn in u:
         yield ' '
-        yield E.SPAN(base)
-        if expn!=1: yield E.SUP(str(expn))
-    return tostring(E.TABLE(E.TBODY(*(r for x in functions(self.L) for r in row(x)))),encoding='unicode')
+        yield SPAN(base)
+        if expn!=1: yield SUP(str(expn))
+    return tostring(TABLE(TBODY(*[r for x in functions(self.L) for r in row(x)])),encoding='unicode')
 
   def __repr__(self):
     def row(f):
       yield f'**** {pname(f)} ****'
       H,D = f.setup
       for argn,(txt,unit) in H.items():
-        dv = '({:10})'.format(','.join(trim(D[a]) if a in D else '' for a in argn)) if any(a in D for a in argn) else ''
+        dv = defaults(argn,D,trim); dv = '' if dv is None else '({:10})'.format(dv)
         unit = '' if unit is None else ' [{}]'.format('.'.join('{}{}'.format(x[0],('^{}'.format(x[1]) if x[1]!=1 else '')) for x in unit))
         yield '    {:10}{}: {}{}'.format(','.join(argn),dv,txt,unit)
     trim = lambda x: repr(x)[:10]
@@ -83,13 +91,65 @@ Setup.display = display
 # Utilities
 #==================================================================================================
 
+def compile_pat(p):
+  try: return re2.compile(p) # linear time matching
+  except: return re.compile(p)
+
+HELP_PAT = compile_pat(r'(?P<argn>(?:\w|,)+?)\s*:\s+(?P<help>[^[]+)(?:\s+\[(?P<unit>(?:\w+(?:\^-?[0-9]+)?)(?:\.\w+(?:\^-?[0-9]+)?)*)\])?')
+UNIT_PAT = compile_pat(r'(?P<base>[^\^]+)(?:\^(?P<expn>.+))?')
+
+@lru_cache(maxsize=None)
+def lxml_builder():
+  from lxml.builder import E
+  from lxml.etree import tostring
+  return E,tostring
+
+def defaults(argn,D,fmt):
+  found,parts = False,[]
+  for a in argn:
+    if a in D: parts.append(fmt(D[a])); found = True
+    else: parts.append('')
+  return ','.join(parts) if found else None
+
+KEYWORD_KINDS = inspect.Parameter.POSITIONAL_OR_KEYWORD,inspect.Parameter.KEYWORD_ONLY
+
+def same(x,y):
+  try: return x is y or (type(x) is type(y) and bool(x==y))
+  except: return False
+
+def with_defaults(f,D):
+  r"""Returns a copy of function *f* where the defaults of the parameters are updated by *D*, or :const:`None` if some key in *D* is not a parameter which can be given a default."""
+  code = f.__code__
+  pnames = code.co_varnames[:code.co_argcount]; knames = code.co_varnames[code.co_argcount:code.co_argcount+code.co_kwonlyargcount]
+  pdefaults = list(f.__defaults__ or ()); kdefaults = dict(f.__kwdefaults__ or {})
+  offset = len(pnames)-len(pdefaults) # index of the first positional parameter with a default
+  for k,v in D.items():
+    if k in knames: kdefaults[k] = v
+    elif k in pnames and (i:=pnames.index(k))>=max(offset,code.co_posonlyargcount): pdefaults[i-offset] = v
+    else: return None
+  F = FunctionType(code,f.__globals__,f.__name__,tuple(pdefaults),f.__closure__)
+  F.__kwdefaults__ = kdefaults or None
+  update_wrapper(F,f); del F.__wrapped__ # so that the signature of F shows the new defaults
+  return F
+
+def weak_cache(f):
+  r"""Memoizes function *f* of one argument, like :func:`functools.lru_cache`, but without keeping the argument alive (it must be weakly referenceable)."""
+  cache = WeakKeyDictionary()
+  @wraps(f)
+  def F(x):
+    try: return cache[x]
+    except KeyError: r = cache[x] = f(x); return r
+  return F
+
+@weak_cache
 def pname(f):
   return f'{f.__qualname__}{inspect.signature(f)}'
 
 def functions(L):
   for x in L:
     if inspect.isfunction(x): yield x
-    elif inspect.isclass(x):
-      for name,f in inspect.getmembers(x,inspect.isfunction):
-        if hasattr(f,'setup'): yield f
+    elif inspect.isclass(x): yield from members(x)
     else: raise TypeError('expected: function|class; found: {}'.format(type(x)))
+
+def members(c): # not memoized: a class may gain Setup annotated members after being displayed
+  return tuple(f for name,f in inspect.getmembers(c,inspect.isfunction) if hasattr(f,'setup'))
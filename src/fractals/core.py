@@ -11,9 +11,11 @@ from typing import Any, Union, Callable, Iterable, Mapping, Tuple
 
 from itertools import count
 from functools import cached_property
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
-from numpy import ndarray, sqrt, zeros, abs, nan, isnan, linspace
-from .util import Selection
+from numpy import ndarray, sqrt, zeros, empty, arange, count_nonzero, int32, complex64, logical_not, logical_and, divide, putmask, linspace, finfo
+from .util import Selection, BufferPool, prefetch, formula, escape_oracle, lookup_kernel
 
 __all__ = 'Fractal', 'MultiZoomFractal', 'FractalBrowser',
 
@@ -35,19 +37,35 @@ remains bounded.
 
 An escape oracle for the fractal is a boolean function :math:`R` such that if :math:`R(z_n(c))` is true for some :math:`n`, then the whole sequence :math:`(z_n(c))_{n\in\mathbb{N}}` is unbounded and :math:`c` does not belong to the fractal.
 
-:param main: function :math:`u` implemented as a ufunc
-:param eoracle: escape oracle of the fractal (if given as a number `r`, then it is taken to be the function `(lambda z: abs(z)>r)`)
+:param main: function :math:`u` implemented as a ufunc, or as a string expression in ``z`` and ``c`` (see :func:`.util.formula`)
+:param eoracle: escape oracle of the fractal (if given as a number `r`, then it is taken to be the function `(lambda z: ~(abs(z)<=r))`, so that non-finite values escape, see :func:`.util.escape_oracle`)
+:param kernel: a compiled implementation of method :meth:`generate` for this fractal (e.g. :func:`.util.mandelbrot_kernel`), used instead of *main* and *eoracle*; if :const:`None` (default), it is looked up by :func:`.util.lookup_kernel` when *main* is a string and *eoracle* a number; if :const:`False`, no kernel is used
+:param dtype: the complex type of the grids on which this fractal is computed (the default :class:`numpy.complex64` halves memory traffic compared to :class:`complex`, and is promoted by :meth:`MultiZoomFractal.push` at deep zoom levels); the temperature grids are yielded in the corresponding real type
+:param schedule: a function returning, for an iteration index, the index of the next iteration to yield (default: every iteration; see also :func:`.util.geometric_schedule`)
   """
 #==================================================================================================
 
-  def __init__(self,main:Callable[[complex],complex],eoracle:Union[float,Callable[[float],bool]]=None):
-    self.main = main
-    self.eoracle = (lambda z,r=float(eoracle): abs(z)>r) if isinstance(eoracle,(int,float)) else eoracle
+  tile:int = 1<<14
+  r"""Number of points of the tiles in which the grid is iterated when fast-forwarding without a kernel (should fit in cache)"""
+  compact:int = 8
+  r"""Number of iterations between two compactions of the set of points still iterated without a kernel"""
+  workers:int = 1
+  r"""Number of threads across which the tiles are fast-forwarded without a kernel (:mod:`numpy` releases the GIL, but *main* and *eoracle* must then be thread-safe, which is the case when they are given as a string and a number)"""
+
+  def __init__(self,main:Union[str,Callable[[complex],complex]],eoracle:Union[float,Callable[[float],bool]]=None,kernel:Union[Callable[[ndarray],Iterable[ndarray]],bool]=None,dtype:type=complex64,schedule:Callable[[int],int]=None):
+    self.main = formula(main) if isinstance(main,str) else main
+    self.inplace = isinstance(main,str)
+    self.eoracle = escape_oracle(eoracle) if isinstance(eoracle,(int,float)) else eoracle
+    if kernel is None and isinstance(main,str) and isinstance(eoracle,(int,float)): kernel = lookup_kernel(main,eoracle)
+    self.kernel = kernel or None
+    self.dtype = dtype
+    self.schedule = (lambda n: n+1) if schedule is None else schedule
+    self.pool = BufferPool()
 
 #--------------------------------------------------------------------------------------------------
-  def generate(self,grid):
+  def generate(self,grid,start=1):
     r"""
-Successively yields the "temperature" grid :math:`\theta_n(c)` taken on all the points :math:`c` in the grid for :math:`n=1\ldots\infty`, where
+Successively yields the "temperature" grid :math:`\theta_n(c)` taken on all the points :math:`c` in the grid for :math:`n=\textrm{start}\ldots\infty` (only the iterations selected by the schedule of this fractal), where
 
 .. math::
 
@@ -62,17 +80,43 @@ In other words, the temperature :math:`\theta_n(c)` of a point :math:`c` is the
 
 Note that when :math:`n\rightarrow\infty`, the temperature :math:`\theta_n(c)` tends to :math:`1` if :math:`c` belongs to this fractal, and :math:`0` otherwise.
 
+The yielded grids are not allocated at each iteration but written in turn into two buffers: a yielded grid remains valid until the next one is yielded, but is overwritten by the one after. Consumers which need to keep it longer must copy it. All the buffers are recycled for subsequent invocations once the generator is discarded.
+
 :param grid: an array of complex numbers
+:param start: index of the first yielded grid (the previous iterations are performed without yielding, in a single pass per point if a kernel is available, otherwise tile by tile, see :attr:`tile` and :attr:`workers`)
     """
 #--------------------------------------------------------------------------------------------------
-    eoracle = self.eoracle
-    effort = zeros(grid.shape,int)
-    z = grid.copy()
-    for n in count(1):
-      z[eoracle(z)] = nan
-      effort[~isnan(z)] += 1
-      yield effort/n
-      z[...] = self.main(z,grid)
+    if self.kernel is not None: yield from self.kernel(grid,start,self.schedule); return
+    main,eoracle,pool,tile,compact = self.main,self.eoracle,self.pool,self.tile,self.compact
+    if self.inplace: main = lambda z,c,main=main: main(z,c,out=z) # no new array at each iteration
+    else: main = lambda z,c,main=main: main(z,c).astype(z.dtype,copy=False) # so that the state keeps the precision of the grid
+    def escape(z,alive): # escaped points are marked dead in alive, and reset to 0 so they remain finite until dropped
+      e = eoracle(z); putmask(z,e,0)
+      return logical_and(alive,logical_not(e,out=e),out=alive)
+    effort = pool.get(grid.shape,int32); effort[...] = 0 # halves memory traffic compared to int64
+    alive = pool.get(grid.shape,bool); alive[...] = True
+    out = pool.get((2,*grid.shape),grid.real.dtype)
+    z = pool.get(grid.shape,grid.dtype); z[...] = grid
+    try:
+      z_,grid_,effort_,alive_ = z.reshape(-1),grid.reshape(-1),effort.reshape(-1),alive.reshape(-1)
+      if start>1: # fast-forward tile by tile, so that the state of a tile stays in cache across iterations
+        def forward(s):
+          zt,gt,et,at = z_[s],grid_[s],effort_[s],alive_[s]
+          for n in range(1,start):
+            et += escape(zt,at)
+            if (r:=main(zt,gt)) is not zt: zt[...] = r
+        tiles = (slice(k,k+tile) for k in range(0,grid.size,tile))
+        if self.workers>1: # tiles are independent, and are views (not copies) of the state
+          with ThreadPoolExecutor(self.workers) as executor: list(executor.map(forward,tiles))
+        else: list(map(forward,tiles))
+      idx,e_,m,k = arange(grid.size),effort_.copy(),start,0 # e_: effort of the points in idx, scattered into effort only when needed
+      for n in count(start):
+        e_ += escape(z_,alive_)
+        if (c:=n==start or n%compact==0) or n==m: effort_[idx] = e_
+        if c: idx,z_,grid_,e_,alive_ = idx[alive_],z_[alive_],grid_[alive_],e_[alive_],alive_[alive_] # drops the escaped points
+        if n==m: yield divide(effort,n,out=out[k%2]); m = self.schedule(n); k += 1
+        z_ = main(z_,grid_)
+    finally: pool.release(effort,alive,out,z)
 
 #==================================================================================================
 class MultiZoomFractal (Fractal):
@@ -85,24 +129,33 @@ An instance of this class is a fractal together with a stack of rectangles of th
 
   Entry = namedtuple('StackEntry','status seq bounds resolution')
 
+  threaded:bool = True
+  r"""Whether the temperature grids of each level are computed one step ahead in a background thread (see :func:`.util.prefetch`)"""
+
   def __init__(self,*a,ibounds:Tuple[Tuple[float,float],Tuple[float,float]]=None,**ka):
     super().__init__(*a,**ka)
     self.stack = []
     self.ibounds = ibounds
+    self.lock = Lock() # the computations of all the levels share buffers
 
   def trace(self,i,seq):
     status = self.stack[i].status
-    for x in seq: status[0] += 1; status[1] = x; yield x
+    for x in seq: status[0] = self.schedule(status[0]); status[1] = x; yield x
 
   def push(self,resolution,bounds=None,i=0):
     r"""
-Adds the rectangle defined by *bounds* (by default the initial recommended rectangle) with resolution *resolution* at level *i* in the stack (default at the bottom of the stack). All the entries after *i* are deleted.
+Adds the rectangle defined by *bounds* (by default the initial recommended rectangle) with resolution *resolution* at level *i* in the stack (default at the bottom of the stack). All the entries after *i* are deleted. The state of each entry is kept, so returning to a level resumes its iterations: if the entry at level *i* already has the same rectangle and resolution, it is reused as is. Otherwise, the new entry starts at the precision of its parent, reached in a single pass (see :meth:`generate`). Its grid, obtained by :meth:`grid`, is converted to the type of this fractal, or kept in double precision if the grid step is too small for that type.
     """
     if bounds is None: bounds= self.ibounds
+    if i<len(self.stack) and (e:=self.stack[i]).bounds==bounds and e.resolution==resolution: del self.stack[i+1:]; return e
     del self.stack[i:]
     p = self.stack[i-1].status[0] if i>0 else 1
-    seq = self.generate(self.grid(bounds,resolution))
-    for _ in range(p): x = next(seq)
+    grid = self.grid(bounds,resolution)
+    (xmin,xmax),(ymin,ymax) = bounds; Ny,Nx = grid.shape
+    dtype = self.dtype if finfo(self.dtype).eps*max(abs(xmin),abs(xmax),abs(ymin),abs(ymax)) <= 2**-10*min((xmax-xmin)/Nx,(ymax-ymin)/Ny) else complex # grid step must span at least 2^10 ulps
+    seq = self.generate(grid.astype(dtype,copy=False),p)
+    with self.lock: x = next(seq)
+    if self.threaded: seq = prefetch(seq,self.lock)
     e = self.Entry([p,x],self.trace(i,seq),bounds,resolution)
     self.stack.append(e)
     return e
@@ -113,7 +166,9 @@ Adds the rectangle defined by *bounds* (by default the initial recommended recta
     (xmin,xmax),(ymin,ymax) = bounds
     r = (ymax-ymin)/(xmax-xmin)
     Ny = int(sqrt(resolution*r)); Nx = int(resolution/Ny) # Ny/Nx~r and Nx.Ny~resolution
-    return linspace(xmin,xmax,Nx,dtype=complex)[None,:]+1.j*linspace(ymin,ymax,Ny,dtype=complex)[:,None]
+    grid = empty((Ny,Nx),complex) # real and imaginary planes filled by broadcasting, without complex temporaries
+    grid.real[...] = linspace(xmin,xmax,Nx)[None,:]; grid.imag[...] = linspace(ymin,ymax,Ny)[:,None]
+    return grid
 
 #==================================================================================================
 class FractalBrowser:
@@ -126,6 +181,8 @@ An instance of this class is a fractal browser, which allows zooming at controll
 
   player:Any
   r"""An object managing the user control (selected automatically based on the :mod:`matplotlib` backend, but can be changed)"""
+  burst_max:int = 16
+  r"""Maximal number of yielded iterations computed per frame: while no point escapes, the number of iterations per frame doubles at each frame up to this value, so that the computation speeds up while the image hardly changes, without slowing down the frame rate"""
 
   def __init__(self,content:MultiZoomFractal,**ka):
     def displayer(fig,select):
@@ -135,12 +192,17 @@ An instance of this class is a fractal browser, which allows zooming at controll
       img = ax.imshow(zeros((1,1),float),vmin=0.,vmax=1.,extent=(*bounds[0],*bounds[1]),origin='lower',cmap='jet',interpolation='bilinear')
       rect = ax.add_patch(Rectangle((0,0),width=0,height=0,alpha=.2,color='k',visible=False,lw=3,zorder=5))
       self.selection = Selection(ax,select,alpha=.4,zorder=10)
-      level = entry = None
+      level = entry = undecided = None; burst = 1
       def disp(i,new=None):
-        nonlocal level,entry
-        if i==level: a = next(entry.seq)
+        nonlocal level,entry,undecided,burst
+        if i==level:
+          for _ in range(burst): a = next(entry.seq)
+          u = count_nonzero(a==1.)
+          if u==0: self.player.setrunning(False) # all the points are decided: further iterations would only dim the image
+          else: burst = min(2*burst,self.burst_max) if u==undecided else 1 # speed up while no point escapes
+          undecided = u
         else:
-          level,entry = i,(stack[i] if new is None else push(*new,i))
+          level,entry,undecided,burst = i,(stack[i] if new is None else push(*new,i)),None,1
           img.set_extent((*entry.bounds[0],*entry.bounds[1]))
           if i == len(stack)-1: rect.set(visible=False)
           else:
@@ -7,10 +7,15 @@
 
 from __future__ import annotations
 
-import traceback
+import traceback, ast
 from typing import Any, Union, Callable, Iterable, Mapping, Sequence, Tuple
 import logging; logger = logging.getLogger(__name__)
 
+from itertools import count
+from functools import partial
+from threading import local
+from numpy import ndarray, empty, zeros, arange, divide, multiply, add, less_equal, logical_not, int32, int64, dtype as npdtype
+
 from matplotlib import rcParams
 from matplotlib.pyplot import figure
 from matplotlib.figure import Figure
@@ -19,41 +24,81 @@ from matplotlib.backend_bases import MouseButton
 from matplotlib.patches import Rectangle
 try: from myutil.ipywidgets import app, SimpleButton # so this works even if ipywidgets is not available
 except: app = object
+try: from numba import njit, prange, parallel_chunksize # so this works even if numba is not available
+except: njit = None
+try: from numba import cuda # so this works even if numba is not available
+except: cuda = None
+try: from numexpr import NumExpr, get_num_threads # so this works even if numexpr is not available
+except: NumExpr = None
 
 #==================================================================================================
 class Selection:
 #==================================================================================================
+
+  throttle:int = 16
+  r"""Minimal interval (in msec) between two successive displays of the rectangle while it is dragged"""
+
   def __init__(self,ax,callback=None,min_size=1e-10,**ka):
     ax.figure.canvas.mpl_connect('button_press_event',self.start)
-    ax.figure.canvas.mpl_connect('button_release_event',self.stop)
-    ax.figure.canvas.mpl_connect('motion_notify_event',self.updt)
-    self.canvas = ax.figure.canvas
-    self.rec = ax.add_patch(Rectangle((0,0),width=0,height=0,color='k',visible=False,**ka))
+    ax.figure.canvas.mpl_connect('draw_event',self.refresh)
+    self.cids = () # motion and release events are listened to only while a rectangle is dragged
+    self.canvas = canvas = ax.figure.canvas
+    self.blit = canvas.supports_blit # the rectangle is then drawn over a saved background, without redrawing the figure
+    self.rec = ax.add_patch(Rectangle((0,0),width=0,height=0,color='k',visible=False,animated=self.blit,**ka))
     self.min_size = min_size
     self.bbox = None
+    self.background = None
     self.callback = callback
+    self.timer = timer = canvas.new_timer(interval=self.throttle) # motion events are coalesced until it fires
+    timer.single_shot = True; timer.add_callback(self.flush)
+    self.pending = False
 
   def start(self,ev):
     if ev.inaxes is self.rec.axes and ev.button == MouseButton.LEFT and self.bbox is None:
       p = ev.xdata, ev.ydata
       self.bbox = [p,p]
+      self.cids = self.canvas.mpl_connect('motion_notify_event',self.updt),self.canvas.mpl_connect('button_release_event',self.stop)
       self.rec.set(xy=p,width=0,height=0,visible=True)
-      self.canvas.draw_idle()
+      if self.blit: self.background = self.canvas.copy_from_bbox(self.rec.axes.bbox); self.show()
+      else: self.canvas.draw_idle()
 
   def updt(self,ev):
     if ev.inaxes is self.rec.axes and self.bbox is not None:
       p = self.bbox[0]
       p1 = self.bbox[1] = ev.xdata, ev.ydata
       self.rec.set(width=p1[0]-p[0],height=p1[1]-p[1])
-      self.canvas.draw_idle()
+      if not self.pending: self.pending = True; self.timer.start()
 
   def stop(self,ev):
     if ev.inaxes is self.rec.axes and ev.button == MouseButton.LEFT and self.bbox is not None:
-      p,p1 = self.bbox
+      (x,y),(x1,y1) = self.bbox
       self.bbox = None
+      for cid in self.cids: self.canvas.mpl_disconnect(cid)
+      self.cids = ()
+      self.pending = False
       self.rec.set(visible=False)
-      if abs(p1[0]-p[0])<self.min_size or abs(p1[1]-p[1])<self.min_size: self.canvas.draw_idle()
-      else: self.callback((tuple(sorted((p[0],p1[0]))),tuple(sorted((p[1],p1[1])))))
+      small = abs(x1-x)<self.min_size or abs(y1-y)<self.min_size
+      if self.blit or small: self.show() # erases the rectangle (otherwise done by the callback)
+      self.background = None
+      if not small: self.callback(((x,x1) if x<x1 else (x1,x),(y,y1) if y<y1 else (y1,y)))
+
+  def flush(self):
+    if self.pending: self.pending = False; self.show()
+
+  def show(self):
+    r"""Shows the current state of the rectangle: by restoring the saved background and drawing the rectangle over it if blitting is supported, otherwise by redrawing the figure."""
+    if self.background is None: self.canvas.draw_idle(); return
+    ax = self.rec.axes
+    self.canvas.restore_region(self.background)
+    ax.draw_artist(self.rec)
+    self.canvas.blit(ax.bbox)
+
+  def refresh(self,ev):
+    r"""Invoked after each full redraw of the figure (which ignores the rectangle when blitting), e.g. by the animation: the background is saved again and the rectangle drawn over it."""
+    if self.background is not None:
+      ax = self.rec.axes
+      self.background = self.canvas.copy_from_bbox(ax.bbox)
+      ax.draw_artist(self.rec)
 
 #==================================================================================================
 class player_base:
@@ -71,6 +116,7 @@ An instance of this class controls the exploration of a fractal.
     self.level = -1
     self.anim = FuncAnimation(self.board,(lambda i: None if i is None else self.show_precision(display(i))),frames,init_func=(lambda: None),repeat=False,**ka)
 
+
   def setrunning(self,b:bool=None):
     r"""Sets the running state of the animation to *b* (if :const:`None`, the inverse of current running state)."""
     if b is None: b = not self.running
@@ -191,3 +237,301 @@ This class refines :class:`player_base` for backends which do not support :mod:`
           if 0<=i<=level_max: setlevel(i)
     toolbar.canvas.mpl_connect('button_press_event',on_button_press)
     super().__init__(display,**ka)
+
+#==================================================================================================
+class BufferPool:
+  r"""
+An instance of this class is a pool of arrays indexed by shape and dtype. Released arrays are recycled by subsequent requests with the same shape and dtype, which avoids allocating (and page-faulting) fresh memory each time a grid of the same size is needed.
+  """
+#==================================================================================================
+  def __init__(self): self.free = {}
+
+  def get(self,shape:Tuple[int,...],dtype:type)->ndarray:
+    r"""Returns an array of shape *shape* and dtype *dtype*, uninitialised."""
+    L = self.free.get((shape,dtype:=npdtype(dtype)))
+    try: return L.pop() # atomic, so that the pool can be shared by generators running in different threads
+    except (AttributeError,IndexError): return empty(shape,dtype)
+
+  def release(self,*L:ndarray):
+    r"""Returns the arrays in *L* to this pool."""
+    for x in L: self.free.setdefault((x.shape,x.dtype),[]).append(x)
+
+#==================================================================================================
+def prefetch(seq:Iterable[Any],lock:Any)->Iterable[Any]:
+  r"""
+:param seq: an iterator
+:param lock: a lock held while an element of *seq* is computed
+
+Returns an iterator with the same elements as *seq*, computed one step ahead in a background thread: the next element is computed while the current one is used (e.g. displayed). The element after is not computed until the next one is requested, so the consumer never holds more than the current element, as required by :meth:`.core.Fractal.generate` for its reusable buffers. The computation can overlap with the consumer only where it releases the GIL (:mod:`numpy` operations on large arrays, compiled kernels).
+  """
+#==================================================================================================
+  from threading import Thread
+  from queue import SimpleQueue
+  request,result = SimpleQueue(),SimpleQueue()
+  def run():
+    while request.get():
+      try:
+        with lock: x = next(seq)
+      except BaseException as exc: result.put((False,exc)); return
+      result.put((True,x))
+  Thread(target=run,daemon=True).start()
+  request.put(True)
+  try:
+    while True:
+      ok,x = result.get()
+      if not ok:
+        if isinstance(x,StopIteration): return
+        raise x
+      request.put(True)
+      yield x
+  finally: request.put(False)
+
+#==================================================================================================
+def formula(expr:str)->Callable[[ndarray,ndarray],ndarray]:
+  r"""
+:param expr: an arithmetic expression in variables ``z`` and ``c``
+
+Returns the function of *z*, *c* defined by *expr*, usable as *main* argument of :class:`.core.Fractal`. The expression is compiled once (per thread), with :mod:`numexpr` if available (evaluated in a single pass without intermediate arrays), otherwise as a :mod:`numpy` expression. The returned function also accepts a keyword argument *out*, an array into which the result is written (possibly *z* itself).
+  """
+#==================================================================================================
+  if NumExpr is None:
+    import numpy
+    code,env = compile(expr,'<formula>','eval'),dict(vars(numpy))
+    def main(z,c,out=None):
+      r = eval(code,env,dict(z=z,c=c))
+      if out is None: return r
+      out[...] = r; return out
+    return main
+  from numexpr.necompiler import getExprNames
+  names,vml = getExprNames(expr,{})
+  names,buf = tuple(x for x in ('z','c') if x in names),local() # numexpr only accepts the names used in the expression
+  def main(z,c,out=None):
+    try: ex = buf.ex
+    except AttributeError: ex = buf.ex = NumExpr(expr,signature=tuple((x,complex) for x in names)) # compiled programs are not re-entrant, so one per thread
+    args = dict(z=z,c=c)
+    return ex(*(args[x] for x in names),out=out,casting='same_kind',ex_uses_vml=vml)
+  return main
+
+#==================================================================================================
+def escape_oracle(r:float)->Callable[[ndarray],ndarray]:
+  r"""
+:param r: escape radius
+
+Returns the escape oracle :math:`|z|>r`, usable as *eoracle* argument of :class:`.core.Fractal`. It is evaluated on the real and imaginary planes of *z* as :math:`\neg(\Re(z)^2+\Im(z)^2\leq r^2)` (no square root, and non-finite values count as escaped), with :mod:`numexpr` on large arrays if it is available with several threads, into buffers kept from one call to the next as long as the shape does not change, so the returned array is overwritten by the next call in the same thread.
+  """
+#==================================================================================================
+  r2 = float(r)**2
+  buf = local() # buffers are per thread, so that the oracle can be invoked concurrently (see :attr:`.core.Fractal.workers`)
+  def eoracle(z):
+    x,y,e = getattr(buf,'xye',(None,None,None))
+    if x is None or x.shape!=z.shape or x.dtype!=z.real.dtype: x,y,e = buf.xye = empty(z.shape,z.real.dtype),empty(z.shape,z.real.dtype),empty(z.shape,bool)
+    multiply(z.real,z.real,out=x); multiply(z.imag,z.imag,out=y)
+    return logical_not(less_equal(add(x,y,out=x),r2,out=e),out=e) # non-finite values escape
+  if NumExpr is None or get_num_threads()<2: return eoracle
+  eoracle_ = eoracle
+  def eoracle(z): # single multi-threaded pass for large arrays (slower than numpy on a single thread)
+    if z.size<1<<15: return eoracle_(z)
+    ex,e = getattr(buf,'exe',(None,None))
+    if ex is None: ex = NumExpr('~(real(z)*real(z)+imag(z)*imag(z)<=r2)',signature=(('z',complex),('r2',float))) # not re-entrant, so one per thread
+    if e is None or e.shape!=z.shape: e = empty(z.shape,bool)
+    buf.exe = ex,e
+    return ex(z,r2,out=e,ex_uses_vml=False)
+  return eoracle
+
+#==================================================================================================
+def geometric_schedule(n0:int=64,q:float=2.)->Callable[[int],int]:
+  r"""
+:param n0: last iteration of the initial phase
+:param q: ratio
+
+Returns a schedule (see :meth:`.core.Fractal.generate`) which yields every iteration up to *n0*, then only a geometric sequence of ratio *q* (e.g. with the defaults, iterations 64, 128, 256 etc.). The visual difference between successive iterations fades as they progress, and a kernel can perform the iterations between yields in a single pass per point.
+  """
+#==================================================================================================
+  return lambda n: n+1 if n<n0 else max(n+1,int(n*q))
+
+#==================================================================================================
+def mandelbrot_kernel(r:float=2.,compact:int=8,chunksize:int=16):
+  r"""
+:param r: escape radius
+:param compact: number of iterations between two compactions of the set of points still iterated
+:param chunksize: number of groups of points handed at once to a thread when several iterations are performed without yielding
+
+The returned kernel takes as arguments a grid, the first iteration to yield and a schedule giving the iteration to yield after a given one (see :meth:`.core.Fractal.generate`).
+
+Returns a compiled implementation of the Mandelbrot fractal, defined by :math:`u(z,c)=z^2+c` with escape oracle :math:`|z|>r`, suitable as *kernel* argument of :class:`.core.Fractal`, or :const:`None` if :mod:`numba` is not available. The escape test and update are fused into a single parallel pass over the grid, and when several iterations are performed without yielding, each point is iterated in registers before moving on to the next one. Escaped points are periodically dropped from the index of points to iterate, so that the cost of an iteration decreases with the number of undecided points. Since the cost of a burst of iterations varies widely across points, bursts are scheduled dynamically in small chunks across threads rather than in one static block per thread. The compiled code is cached on disk, so only the first run pays for compilation (the cache location can be shared between processes and users through the ``NUMBA_CACHE_DIR`` environment variable).
+  """
+#==================================================================================================
+  if njit is None: return None
+  r2 = float(r)**2
+  pool = BufferPool()
+  def kernel(grid:ndarray,start:int=1,schedule:Callable[[int],int]=(lambda n: n+1)):
+    N,t = grid.size,grid.real.dtype
+    r2_ = t.type(r2) # so that single precision grids are iterated in single precision
+    cr,ci,zr,zi = (pool.get((N,),t) for _ in range(4))
+    cr.reshape(grid.shape)[...] = grid.real; ci.reshape(grid.shape)[...] = grid.imag
+    zr[...] = cr; zi[...] = ci
+    effort = pool.get((N,),int32); effort[...] = 0
+    out = pool.get((2,N),t)
+    alive = arange(N,dtype=int64)
+    n,m,c = 0,start,0 # c: iteration of the last compaction
+    try:
+      for k in count():
+        if m-n==1: mandelbrot_iterate(zr,zi,cr,ci,effort,alive,n,m,r2_)
+        else:
+          with parallel_chunksize(chunksize): mandelbrot_iterate_lanes(zr,zi,cr,ci,effort,alive,n,m,r2_)
+        if n==0 or m-c>=compact: alive = alive[effort[alive]==m]; c = m
+        n,m = m,schedule(m)
+        yield divide(effort,n,out=out[k%2]).reshape(grid.shape)
+    finally: pool.release(cr,ci,zr,zi,effort,out)
+  return kernel
+
+#==================================================================================================
+def mandelbrot_cuda_kernel(r:float=2.,threads:int=256):
+  r"""
+:param r: escape radius
+:param threads: number of threads per block
+
+Same as :func:`mandelbrot_kernel`, but the iterations are performed on a CUDA device, with one thread per point. Returns :const:`None` if no such device is available. The state is kept on the device, and only the effort is copied back to the host at each yielded iteration. The copy happens asynchronously while the previous grid is displayed: the next iteration is launched just before the current grid is yielded.
+  """
+#==================================================================================================
+  if cuda is None or not cuda.is_available(): return None
+  r2 = float(r)**2
+  def kernel(grid:ndarray,start:int=1,schedule:Callable[[int],int]=(lambda n: n+1)):
+    N,t = grid.size,grid.real.dtype
+    blocks = (N+threads-1)//threads
+    stream = cuda.stream()
+    c = grid.reshape(-1)
+    cr,ci = cuda.to_device(c.real.astype(t),stream=stream),cuda.to_device(c.imag.astype(t),stream=stream)
+    zr,zi = cuda.to_device(c.real.astype(t),stream=stream),cuda.to_device(c.imag.astype(t),stream=stream)
+    effort = cuda.to_device(zeros(N,int32),stream=stream)
+    host = cuda.pinned_array((2,N),int32)
+    out = empty((2,N),t)
+    def launch(n,m,k):
+      mandelbrot_cuda_iterate[blocks,threads,stream](zr,zi,cr,ci,effort,n,m,r2)
+      effort.copy_to_host(host[k%2],stream=stream)
+    n = start; launch(0,n,0)
+    for k in count():
+      stream.synchronize()
+      m = schedule(n); launch(n,m,k+1)
+      yield divide(host[k%2],n,out=out[k%2]).reshape(grid.shape)
+      n = m
+  return kernel
+
+#==================================================================================================
+def formula_kernel(expr:str,r:float=2.,compact:int=8):
+  r"""
+:param expr: an arithmetic expression in variables ``z`` and ``c``, possibly using the functions of :mod:`cmath`
+:param r: escape radius
+:param compact: number of iterations between two compactions of the set of points still iterated
+
+Returns a compiled implementation of the fractal defined by :math:`u(z,c)=\textrm{expr}` with escape oracle :math:`|z|>r`, suitable as *kernel* argument of :class:`.core.Fractal`, or :const:`None` if :mod:`numba` is not available or *expr* refers to names other than ``z``, ``c`` and those of :mod:`cmath`. The expression is inlined into a specialised iteration loop, generated and compiled on first use (not cached on disk), with the :mod:`numpy` error model so that poles produce non-finite values, which count as escaped. Otherwise, it behaves like :func:`mandelbrot_kernel`, but on complex numbers.
+  """
+#==================================================================================================
+  import cmath
+  if njit is None or not set(compile(expr,'<formula>','eval').co_names) <= {'z','c',*vars(cmath)}: return None
+  r2 = float(r)**2
+  pool = BufferPool()
+  iterate = None
+  def kernel(grid:ndarray,start:int=1,schedule:Callable[[int],int]=(lambda n: n+1)):
+    nonlocal iterate
+    if iterate is None:
+      env = dict(vars(cmath),prange=prange)
+      exec(FORMULA_ITERATE.format(expr=ast.unparse(DivisionGuard().visit(ast.parse(expr,mode='eval')))),env)
+      env['div'] = njit(error_model='numpy')(env['div'])
+      iterate = njit(parallel=True,fastmath=FASTMATH_FINITE,error_model='numpy',nogil=True)(env['iterate']) # poles yield non-finite values instead of raising
+    N = grid.size
+    r2_ = grid.real.dtype.type(r2)
+    C,Z = pool.get((N,),grid.dtype),pool.get((N,),grid.dtype)
+    C.reshape(grid.shape)[...] = grid; Z[...] = C
+    effort = pool.get((N,),int32); effort[...] = 0
+    out = pool.get((2,N),grid.real.dtype)
+    alive = arange(N,dtype=int64)
+    n,m,c = 0,start,0 # c: iteration of the last compaction
+    try:
+      for k in count():
+        iterate(Z,C,effort,alive,n,m,r2_)
+        if n==0 or m-c>=compact: alive = alive[effort[alive]==m]; c = m
+        n,m = m,schedule(m)
+        yield divide(effort,n,out=out[k%2]).reshape(grid.shape)
+    finally: pool.release(C,Z,effort,out)
+  return kernel
+
+class DivisionGuard (ast.NodeTransformer):
+  r"""Replaces each division in a formula by a call to ``div`` (defined in :data:`FORMULA_ITERATE`), since :mod:`numba` raises on complex division by zero whatever its error model"""
+  def visit_BinOp(self,node):
+    node = self.generic_visit(node)
+    return ast.Call(ast.Name('div',ast.Load()),[node.left,node.right],[]) if isinstance(node.op,ast.Div) else node
+
+FORMULA_ITERATE = '''
+def div(a,b): return a/b if b!=0 else complex(nan,nan)
+def iterate(Z,C,effort,alive,n,m,r2):
+  for j in prange(alive.shape[0]):
+    i = alive[j]
+    if effort[i]<n: continue
+    z,c = Z[i],C[i]
+    for k in range(n+1,m+1):
+      if not z.real*z.real+z.imag*z.imag<=r2: break # non-finite orbits escape
+      effort[i] = k; z = {expr}
+    Z[i] = z
+'''
+
+FASTMATH_FINITE = {'nsz','arcp','contract','afn','reassoc'}
+r"""The fast-math flags of :mod:`numba` except those which assume finite values (``nnan``, ``ninf``), for formulas which may produce them"""
+
+KERNELS:dict[str,Callable[[float],Any]] = {'z*z+c':mandelbrot_kernel,'z**2+c':mandelbrot_kernel}
+r"""Registry of kernel factories (e.g. :func:`mandelbrot_kernel`) indexed by the formula they implement (without spaces), each taking the escape radius as argument"""
+
+def lookup_kernel(expr:str,r:float)->Union[Callable[[ndarray],Iterable[ndarray]],None]:
+  r"""Returns the compiled kernel registered in :data:`KERNELS` for formula *expr* with escape radius *r*, or if there is none, the one generated by :func:`formula_kernel`, or :const:`None` if unavailable."""
+  factory = KERNELS.get(''.join(expr.split()),partial(formula_kernel,expr))
+  return factory(r)
+
+if njit is not None:
+  @njit(parallel=True,fastmath=True,nogil=True,cache=True)
+  def mandelbrot_iterate(zr,zi,cr,ci,effort,alive,n,m,r2):
+    r"""Performs iterations *n* +1 to *m* on the points of *c* indexed by *alive* which have not escaped after *n* iterations (i.e. such that *effort* equals *n*). Complex numbers are split into their real and imaginary parts, in single or double precision (compiled on first use for each, and cached on disk)."""
+    for j in prange(alive.shape[0]):
+      i = alive[j]
+      if effort[i]<n: continue
+      x,y,a,b = zr[i],zi[i],cr[i],ci[i]
+      for k in range(n+1,m+1):
+        x2,y2 = x*x,y*y
+        if x2+y2>r2: break
+        effort[i] = k; y = 2*x*y+b; x = x2-y2+a
+      zr[i],zi[i] = x,y
+
+  LANES = 8
+  @njit(parallel=True,fastmath=True,nogil=True,cache=True)
+  def mandelbrot_iterate_lanes(zr,zi,cr,ci,effort,alive,n,m,r2):
+    r"""Same as :func:`mandelbrot_iterate`, but points are processed in groups of :data:`LANES` with a branchless update, so that the compiler can map a group onto SIMD registers; a group stops when all its points have escaped. Faster for long bursts of iterations, slower for a single one."""
+    N = alive.shape[0]
+    for g in prange((N+LANES-1)//LANES):
+      x,y,a,b,e = empty(LANES,zr.dtype),empty(LANES,zr.dtype),empty(LANES,zr.dtype),empty(LANES,zr.dtype),empty(LANES,int32)
+      for l in range(LANES): # the last group is padded with copies of the last point
+        i = alive[min(g*LANES+l,N-1)]
+        x[l],y[l],a[l],b[l],e[l] = zr[i],zi[i],cr[i],ci[i],effort[i]
+      for k in range(n+1,m+1):
+        live = 0
+        for l in range(LANES):
+          x2,y2 = x[l]*x[l],y[l]*y[l]
+          ok = (x2+y2<=r2)&(e[l]==k-1)
+          e[l] += ok; live += ok
+          yn,xn = 2*x[l]*y[l]+b[l],x2-y2+a[l]
+          x[l] = xn if ok else x[l]; y[l] = yn if ok else y[l]
+        if live==0: break
+      for l in range(min(LANES,N-g*LANES)):
+        i = alive[g*LANES+l]
+        zr[i],zi[i],effort[i] = x[l],y[l],e[l]
+
+if cuda is not None:
+  @cuda.jit(cache=True)
+  def mandelbrot_cuda_iterate(zr,zi,cr,ci,effort,n,m,r2):
+    r"""Same as :func:`mandelbrot_iterate`, for one point per thread on a CUDA device."""
+    i = cuda.grid(1)
+    if i>=zr.shape[0] or effort[i]<n: return
+    x,y,a,b = zr[i],zi[i],cr[i],ci[i]
+    for k in range(n+1,m+1):
+      x2,y2 = x*x,y*y
+      if x2+y2>r2: break
+      effort[i] = k; y = 2*x*y+b; x = x2-y2+a
+    zr[i],zi[i] = x,y
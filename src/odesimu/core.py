@@ -7,13 +7,18 @@
 
 from __future__ import annotations
 import logging; logger = logging.getLogger(__name__)
-from typing import Any, Union, Callable, Iterable, Mapping, Tuple
+from typing import Any, Union, Callable, Iterable, Mapping, Sequence, Tuple, List
 
 from functools import partial
 from itertools import repeat, islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pickle import PicklingError
 from scipy.integrate import solve_ivp
 from myutil.simpy import RobustEnvironment
-from numpy import ndarray,array,arange,concatenate
+from numpy import ndarray,array,empty,arange,float32
+try: from loky import get_reusable_executor # so this works even if loky is not available
+except: get_reusable_executor = None
 
 __all__ = 'ODEEnvironment', 'System',
 
@@ -60,8 +65,10 @@ The cache specification *cache* is either :const:`None`, in which case no cachin
   r"""Cache sampling period"""
   cache_last: int
   r"""Index of the last cached state"""
+  cache_dtype: type = float32
+  r"""Type of the cached states (single precision is enough for display, and halves the memory traffic)"""
   cache: ndarray
-  r"""The cache itself (the time axis is the last axis)"""
+  r"""The cache itself (the time axis is the last axis), as a ring buffer of states indexed by decreasing time, stored twice in a row so that any sequence of consecutive states is a contiguous slice"""
 
   def __init__(self,period:Union[float,Iterable[float],Callable[[],float]]=None,cache:Tuple[int,float]=None,init_t:float=0.,init_y:ndarray=None,**spec):
     if callable(period): period_ = period
@@ -101,21 +108,33 @@ The cache specification *cache* is either :const:`None`, in which case no cachin
     else: self.cache_length,self.cache_period = spec
 
   def cache_reset(self):
-    self.cache = self.init_y[:,None]
+    self.cache = empty((*self.init_y.shape,4*self.cache_length),self.cache_dtype)
     self.cache_last = int((self.now-self.init_t)/self.cache_period)
+    self.cache_store(self.cache_last,self.init_y[...,None])
 
   def cache_update(self,t_f):
     n = int((t_f-self.init_t)/self.cache_period)
     if n>self.cache_last:
-      x = self.statef(self.init_t+arange(n,self.cache_last,-1)*self.cache_period)
-      self.cache = concatenate((x,self.cache[:,:self.cache_length]),axis=-1)
+      if (N:=n-self.cache_last+self.cache_length)>self.cache.shape[-1]//2: # the ring must hold the new states and those still visible before them
+        x = self.cache_window(self.cache_last,self.cache_length)
+        self.cache = empty((*self.init_y.shape,2*N),self.cache_dtype)
+        self.cache_store(self.cache_last,x)
+      self.cache_store(n,self.statef(self.init_t+arange(n,self.cache_last,-1)*self.cache_period))
       self.cache_last = n
 
+  def cache_store(self,n,x):
+    N = self.cache.shape[-1]//2
+    i = arange(-n,x.shape[-1]-n)%N # state of index k is at position -k modulo N (and its mirror N further)
+    self.cache[...,i] = x; self.cache[...,i+N] = x
+
+  def cache_window(self,n,m):
+    i = -n%(self.cache.shape[-1]//2)
+    return self.cache[...,i:i+min(m,n+1)] # no state before index 0
+
   @property
   def cached_states(self):
     r"""States of a sequence of states at previous instants in the simulation"""
-    n = self.cache_last-int((self.now-self.init_t)/self.cache_period)
-    return self.cache[:,n:n+self.cache_length]
+    return self.cache_window(int((self.now-self.init_t)/self.cache_period),self.cache_length)
 
 #==================================================================================================
 class System:
@@ -123,6 +142,7 @@ class System:
 Instances of this class gather information for a simulation as implemented by class :class:`myutil.simpy.SimpySimulation`.
   """
 #==================================================================================================
+  __slots__ = () # so that subclasses may declare slots
   factory = ODEEnvironment
   fun = None
   r"""(required) Function :math:`F` to use in the ODE :math:`\frac{\mathbf{d}y}{\mathbf{d}t}=F(t,y)`"""
@@ -149,5 +169,22 @@ Returns a tuple comprising an instance of class :class:`ODEEnvironment` and vari
     if displayers and isinstance(displayers[-1],dict): displayers[-1] = partial(self.displayer,**displayers[-1])
     else: displayers.append(self.displayer)
     return env,*displayers
+  def solve(self,t_eval:Sequence[float],init_y=None,**ka)->ndarray:
+    r"""Returns the states at the instants *t_eval* (time is the last axis) of the trajectory starting at the first of these instants, computed without simulation nor display. The ODE and the initial state are specified as in method :meth:`launch`, except that the arguments *ka* are passed only to function :func:`scipy.integrate.solve_ivp` (the keys of :attr:`launch_defaults` specific to :class:`ODEEnvironment` are ignored)."""
+    init_y = self.makestate(**init_y) if isinstance(init_y,dict) else self.makestate(*init_y)
+    spec = dict(dict(fun=self.fun,jac=self.jac,**self.launch_defaults),**ka)
+    for k in 'period','cache','init_t': spec.pop(k,None)
+    r = solve_ivp(t_span=(t_eval[0],t_eval[-1]),y0=init_y,t_eval=t_eval,**spec)
+    if not r.success: raise self.factory.Exception(r.message)
+    return r.y
+  def ensemble(self,t_eval:Sequence[float],inits:Iterable[Any],workers:int=None,**ka)->List[ndarray]:
+    r"""Returns the list of the results of method :meth:`solve` for each initial state specification in *inits*, with the same *t_eval* and *ka*. The trajectories are independent, and are computed in parallel in *workers* processes (default: the number of processors), with :mod:`loky` if available, otherwise :class:`concurrent.futures.ProcessPoolExecutor`. This instance is passed to the processes, which must be able to load its class: without :mod:`loky`, a class defined in ``__main__`` (e.g. in a notebook) cannot be loaded by processes started by ``spawn``, the default method on MacOS and Windows. If the processes fail to load it, the trajectories are computed sequentially in the current process, with a warning."""
+    inits,solve = list(inits),partial(self.solve,t_eval,**ka)
+    try:
+      if get_reusable_executor is not None: return list(get_reusable_executor(workers).map(solve,inits)) # pickles classes defined in __main__ by value
+      with ProcessPoolExecutor(workers) as executor: return list(executor.map(solve,inits))
+    except (BrokenProcessPool,PicklingError,AttributeError) as e: # AttributeError: class not found (or local) when pickling or unpickling
+      logger.warning('Ensemble not computed in parallel (%s: %s), probably because class %s cannot be loaded by the worker processes; computing it sequentially',type(e).__name__,e,type(self).__qualname__)
+      return list(map(solve,inits))
 
 def noop(*a,**ka): pass